@@ -2,6 +2,8 @@
 -- Ensures data persistence across sessions and restarts
 
 -- Drop existing tables if they exist (for clean setup)
+DROP TABLE IF EXISTS note_last_keys CASCADE;
+DROP TABLE IF EXISTS note_transitions CASCADE;
 DROP TABLE IF EXISTS note_events CASCADE;
 DROP TABLE IF EXISTS songs CASCADE;
 DROP TABLE IF EXISTS analytics_cache CASCADE;
@@ -67,6 +69,25 @@ CREATE TABLE note_events (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Note Transitions Table
+-- Per-user bigram counts (previous key -> next key) for next-note prediction
+CREATE TABLE note_transitions (
+    user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+    prev_key INTEGER NOT NULL CHECK (prev_key >= 0 AND prev_key < 128),
+    next_key INTEGER NOT NULL CHECK (next_key >= 0 AND next_key < 128),
+    count BIGINT NOT NULL,
+    PRIMARY KEY (user_id, prev_key, next_key)
+);
+
+-- Note Last Keys Table
+-- Last key written per user, the previous key of that user's next transition,
+-- and the number of note_events written for them
+CREATE TABLE note_last_keys (
+    user_id VARCHAR(255) PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    last_key INTEGER CHECK (last_key >= 0 AND last_key < 128),
+    event_count BIGINT NOT NULL DEFAULT 0
+);
+
 -- Analytics Cache Table
 -- Stores pre-computed analytics to improve performance
 CREATE TABLE analytics_cache (
@@ -74,6 +95,7 @@ CREATE TABLE analytics_cache (
     user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
     analysis_type VARCHAR(100) NOT NULL,
     results JSONB NOT NULL,
+    cached_event_count BIGINT, -- note_last_keys.event_count the results were computed at
     computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(user_id, analysis_type)
@@ -113,6 +135,7 @@ CREATE INDEX idx_songs_is_public ON songs(is_public);
 CREATE INDEX idx_songs_tags ON songs USING GIN(tags);
 
 CREATE INDEX idx_note_events_user_id ON note_events(user_id);
+CREATE INDEX idx_note_events_user_ts ON note_events(user_id, timestamp DESC, event_id DESC);
 CREATE INDEX idx_note_events_timestamp ON note_events(timestamp);
 CREATE INDEX idx_note_events_key_number ON note_events(key_number);
 CREATE INDEX idx_note_events_created_at ON note_events(created_at);
@@ -168,6 +191,56 @@ CREATE TRIGGER update_user_stats_on_note
     FOR EACH ROW
     EXECUTE FUNCTION update_user_stats();
 
+-- Function to record bigram transitions for inserted notes, chaining each
+-- user's first new note from note_last_keys, and count the notes there
+CREATE OR REPLACE FUNCTION record_note_transitions()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Lock each user's last-key row in user order, creating missing ones
+    INSERT INTO note_last_keys (user_id)
+    SELECT DISTINCT user_id FROM new_events
+    WHERE user_id IS NOT NULL
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET last_key = note_last_keys.last_key;
+    
+    INSERT INTO note_transitions (user_id, prev_key, next_key, count)
+    SELECT user_id, prev_key, key_number, COUNT(*)
+    FROM (
+        SELECT e.user_id, e.key_number,
+               LAG(e.key_number, 1, k.last_key) OVER (
+                   PARTITION BY e.user_id ORDER BY e.event_id
+               ) AS prev_key
+        FROM new_events e
+        JOIN note_last_keys k ON k.user_id = e.user_id
+    ) steps
+    WHERE prev_key BETWEEN 0 AND 127 AND key_number BETWEEN 0 AND 127
+    GROUP BY user_id, prev_key, key_number
+    ORDER BY user_id, prev_key, key_number
+    ON CONFLICT (user_id, prev_key, next_key)
+    DO UPDATE SET count = note_transitions.count + EXCLUDED.count;
+    
+    UPDATE note_last_keys k
+    SET last_key = e.key_number,
+        event_count = k.event_count + e.inserted
+    FROM (
+        SELECT DISTINCT ON (user_id) user_id, key_number,
+               COUNT(*) OVER (PARTITION BY user_id) AS inserted
+        FROM new_events
+        WHERE user_id IS NOT NULL
+        ORDER BY user_id, event_id DESC
+    ) e
+    WHERE k.user_id = e.user_id;
+    
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER record_note_transitions_on_insert
+    AFTER INSERT ON note_events
+    REFERENCING NEW TABLE AS new_events
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION record_note_transitions();
+
 -- Function to update song count
 CREATE OR REPLACE FUNCTION update_song_count()
 RETURNS TRIGGER AS $$
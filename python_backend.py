@@ -4,16 +4,28 @@ Handles: Machine learning analysis, pattern recognition, user behavior analytics
 """
 
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+from typing import Annotated, List, Optional
 import numpy as np
+from numba import njit
+import orjson
 from datetime import datetime
+import time
 import asyncio
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.pool import ThreadedConnectionPool
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+logger = logging.getLogger(__name__)
 
 # Database Configuration
 DB_CONFIG = {
@@ -24,177 +36,854 @@ DB_CONFIG = {
     'port': 5432
 }
 
+# Database connections allowed across all server processes
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 32))
+
+# CPUs this process may run on (respects container cpusets where supported)
+USABLE_CPUS = (
+    len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+    else os.cpu_count() or 1
+)
+
+# Server processes, by default one per usable CPU while every worker can
+# still get at least two connections
+API_WORKERS = int(os.environ.get(
+    'API_WORKERS', min(USABLE_CPUS, max(1, DB_MAX_CONNECTIONS // 2))
+))
+
+# Connection pool bounds per worker, splitting DB_MAX_CONNECTIONS between them
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', max(1, 4 // API_WORKERS)))
+DB_POOL_MAX_CONN = int(os.environ.get(
+    'DB_POOL_MAX_CONN', max(2, DB_MAX_CONNECTIONS // API_WORKERS)
+))
+
+# Shared connection pool, created on startup
+db_pool: Optional[ThreadedConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+# ThreadedConnectionPool raises instead of waiting once all connections are
+# out, so db_conn callers queue here for one of the DB_POOL_MAX_CONN slots
+_db_conn_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+
+# Number of keys on the keyboard; key numbers are 0..PIANO_KEYS-1
+PIANO_KEYS = 128
+
+# Melodies shorter than this are analyzed in pure Python; NumPy setup
+# costs more than the work itself
+SHORT_SEQUENCE_NOTES = 4
+
+# Per-user bigram models kept in memory, least recently used evicted first;
+# each is a 64 KiB PIANO_KEYS x PIANO_KEYS int32 matrix
+MAX_USER_MODELS = 1024
+
+# Seconds before a cached model is reloaded from note_transitions, picking up
+# notes written by other workers
+USER_MODEL_TTL = 30
+
+# recent_notes_count reports the user's notes up to this many
+RECENT_NOTES_WINDOW = 20
+
+# Serializes init_database across workers starting at the same time
+INIT_DB_LOCK_ID = 128_001
+
+# Note events are buffered and written to the database in batches
+EVENT_QUEUE_MAX = 10000
+EVENT_BATCH_SIZE = 256
+EVENT_FLUSH_INTERVAL = 0.05  # seconds
+EVENT_FLUSH_ATTEMPTS = 2  # batch attempts before falling back to single rows
+EVENT_RETRY_DELAY = 0.1  # seconds
+
+event_queue: Optional[asyncio.Queue] = None
+event_writer_task: Optional[asyncio.Task] = None
+
 class NoteEvent(BaseModel):
     user_id: str
-    key_number: int
-    velocity: float
+    key_number: int = Field(ge=0, lt=PIANO_KEYS)
+    velocity: float = Field(ge=0, le=1)
     timestamp: float
 
 class Song(BaseModel):
     user_id: str
     song_name: str
-    notes: List[int]
+    # Any int64, the range _scan_notes and orjson handle
+    notes: List[Annotated[int, Field(ge=-2**63, lt=2**63)]]
     metadata: Optional[dict] = None
 
+# Numeric kernels carry explicit signatures so they are compiled (or loaded
+# from the on-disk cache, see NUMBA_CACHE_DIR) at import time rather than on
+# the first request.
+@njit('u8(u8)', cache=True)
+def _popcount64(x):
+    """Count set bits in a uint64 (SWAR)"""
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+@njit('Tuple((f8, f8, i8, i8, f8, f8, i8, i8, i8, i8))(i8[::1])', cache=True, fastmath=True)
+def _scan_notes(arr):
+    """
+    Single pass over a note array computing pitch statistics and bounds,
+    interval statistics and the number of unique keys. Returns (mean_pitch,
+    pitch_variance, lowest, highest, mean_interval, interval_variance,
+    ascending, descending, repeated, unique); unique is -1 when a note
+    falls outside the piano key range.
+    
+    Means and variances are accumulated in float64 with Welford's method,
+    so large note values cannot overflow or give a negative variance.
+    Unique keys are tracked in a 128-bit bitset (two uint64 words), so no
+    sort or allocation is needed.
+    """
+    n = arr.shape[0]
+    one = np.uint64(1)
+    bits_lo = np.uint64(0)
+    bits_hi = np.uint64(0)
+    in_range = True
+    mean_pitch = 0.0
+    pitch_m2 = 0.0
+    lowest = arr[0] if n > 0 else 0
+    highest = lowest
+    mean_interval = 0.0
+    interval_m2 = 0.0
+    ascending = 0
+    descending = 0
+    repeated = 0
+    
+    for i in range(n):
+        note = arr[i]
+        delta = note - mean_pitch
+        mean_pitch += delta / (i + 1)
+        pitch_m2 += delta * (note - mean_pitch)
+        lowest = min(lowest, note)
+        highest = max(highest, note)
+        
+        if 0 <= note < 64:
+            bits_lo |= one << np.uint64(note)
+        elif 64 <= note < PIANO_KEYS:
+            bits_hi |= one << np.uint64(note - 64)
+        else:
+            in_range = False
+        
+        if i > 0:
+            prev = arr[i - 1]
+            step = np.float64(note) - np.float64(prev)
+            delta = step - mean_interval
+            mean_interval += delta / i
+            interval_m2 += delta * (step - mean_interval)
+            if note > prev:
+                ascending += 1
+            elif note < prev:
+                descending += 1
+            else:
+                repeated += 1
+    
+    pitch_variance = pitch_m2 / n if n > 0 else 0.0
+    interval_variance = interval_m2 / (n - 1) if n > 1 else 0.0
+    
+    unique = np.int64(_popcount64(bits_lo) + _popcount64(bits_hi))
+    if not in_range:
+        unique = -1
+    
+    return (mean_pitch, pitch_variance, lowest, highest,
+            mean_interval, interval_variance, ascending, descending, repeated, unique)
+
 class MLAnalyzer:
     """Machine Learning analyzer for piano patterns"""
     
     def __init__(self):
-        self.note_history = []
-        self.pattern_cache = {}
+        # Per-user state in LRU order: bigram 'counts' (PIANO_KEYS x PIANO_KEYS),
+        # 'last_note' played and 'recent_notes_count' (capped at RECENT_NOTES_WINDOW)
+        self.user_models: "OrderedDict[str, dict]" = OrderedDict()
     
     def analyze_melody(self, notes: List[int]) -> dict:
         """Analyze melody patterns using statistical methods"""
-        if not notes:
+        if len(notes) == 0:
             return {}
         
-        notes_array = np.array(notes)
+        if len(notes) < SHORT_SEQUENCE_NOTES:
+            return self._analyze_short_melody(notes)
+        
+        # Convert once to the contiguous int64 layout _scan_notes is compiled for;
+        # every statistic below comes from that single pass
+        notes_array = np.ascontiguousarray(notes, dtype=np.int64)
+        result = _scan_notes(notes_array)
+        mean_pitch, pitch_variance, lowest, highest = result[:4]
+        scan = result[4:]
+        unique = self._unique_notes(notes_array, scan)
+        note_count = len(notes_array)
         
         analysis = {
-            'mean_pitch': float(np.mean(notes_array)),
-            'std_pitch': float(np.std(notes_array)),
-            'pitch_range': int(np.max(notes_array) - np.min(notes_array)),
-            'unique_notes': len(np.unique(notes_array)),
-            'intervals': self._analyze_intervals(notes),
-            'complexity_score': self._calculate_complexity(notes)
+            'mean_pitch': mean_pitch,
+            'std_pitch': math.sqrt(pitch_variance),
+            # Python ints, so the range of far-apart int64 notes cannot wrap
+            'pitch_range': int(highest) - int(lowest),
+            'unique_notes': unique,
+            'intervals': self._analyze_intervals(note_count, scan),
+            'complexity_score': self._calculate_complexity(note_count, unique, scan)
         }
         
         return analysis
     
-    def _analyze_intervals(self, notes: List[int]) -> dict:
+    def _analyze_short_melody(self, notes: List[int]) -> dict:
+        """analyze_melody for a handful of notes, using Python scalars"""
+        if isinstance(notes, np.ndarray):
+            notes = notes.tolist()
+        
+        note_count = len(notes)
+        mean_pitch = sum(notes) / note_count
+        std_pitch = math.sqrt(sum((note - mean_pitch) ** 2 for note in notes) / note_count)
+        unique = len(set(notes))
+        
+        steps = [b - a for a, b in zip(notes, notes[1:])]
+        mean_interval = sum(steps) / len(steps) if steps else 0.0
+        interval_variance = (
+            sum((step - mean_interval) ** 2 for step in steps) / len(steps)
+            if steps else 0.0
+        )
+        scan = (
+            mean_interval,
+            interval_variance,
+            sum(1 for step in steps if step > 0),
+            sum(1 for step in steps if step < 0),
+            sum(1 for step in steps if step == 0),
+            unique
+        )
+        
+        return {
+            'mean_pitch': mean_pitch,
+            'std_pitch': std_pitch,
+            'pitch_range': max(notes) - min(notes),
+            'unique_notes': unique,
+            'intervals': self._analyze_intervals(note_count, scan),
+            'complexity_score': self._calculate_complexity(note_count, unique, scan)
+        }
+    
+    def analyze_aggregates(self, stats: dict) -> dict:
+        """
+        Build the analyze_melody result from database aggregates
+        (see aggregate_note_events) instead of the raw note list
+        """
+        note_count = stats['note_count']
+        if not note_count:
+            return {}
+        
+        scan = (
+            float(stats['mean_interval'] or 0.0),
+            float(stats['interval_variance'] or 0.0),
+            stats['ascending_steps'],
+            stats['descending_steps'],
+            stats['repeated_notes'],
+            stats['unique_notes']
+        )
+        unique = stats['unique_notes']
+        
+        # AVG/STDDEV come back as Decimal; counts and the range are already ints
+        return {
+            'mean_pitch': float(stats['mean_pitch']),
+            'std_pitch': float(stats['std_pitch']),
+            'pitch_range': stats['pitch_range'],
+            'unique_notes': unique,
+            'intervals': self._analyze_intervals(note_count, scan),
+            'complexity_score': self._calculate_complexity(note_count, unique, scan)
+        }
+    
+    def _unique_notes(self, notes: np.ndarray, scan: tuple) -> int:
+        """Number of distinct keys, from the scan bitset when in range"""
+        unique = scan[5]
+        if unique < 0:
+            unique = len(np.unique(notes))
+        return unique
+    
+    def _analyze_intervals(self, note_count: int, scan: tuple) -> dict:
         """Analyze intervals between consecutive notes"""
-        if len(notes) < 2:
+        if note_count < 2:
             return {}
         
-        intervals = np.diff(notes)
+        mean_interval, _, ascending, descending, repeated, _ = scan
         return {
-            'mean_interval': float(np.mean(intervals)),
-            'ascending_steps': int(np.sum(intervals > 0)),
-            'descending_steps': int(np.sum(intervals < 0)),
-            'repeated_notes': int(np.sum(intervals == 0))
+            'mean_interval': mean_interval,
+            'ascending_steps': ascending,
+            'descending_steps': descending,
+            'repeated_notes': repeated
         }
     
-    def _calculate_complexity(self, notes: List[int]) -> float:
+    def _calculate_complexity(self, note_count: int, unique: int, scan: tuple) -> float:
         """Calculate melody complexity score"""
-        if len(notes) < 2:
+        if note_count < 2:
             return 0.0
         
-        unique_ratio = len(np.unique(notes)) / len(notes)
-        interval_variance = np.var(np.diff(notes))
+        interval_variance = scan[1]
+        unique_ratio = unique / note_count
         
         complexity = (unique_ratio * 0.5 + min(interval_variance / 100, 1.0) * 0.5)
-        return float(complexity)
+        return complexity
+    
+    def has_user_model(self, user_id: str) -> bool:
+        """Whether a bigram model loaded within USER_MODEL_TTL exists for this user"""
+        model = self.user_models.get(user_id)
+        return model is not None and time.monotonic() - model['loaded_at'] < USER_MODEL_TTL
+    
+    def load_model(self, user_id: str, cells: List[int], totals: List[int],
+                   last_note: Optional[int], recent_notes_count: int):
+        """
+        Build a user's bigram model from stored transition counts, given as
+        flat matrix cells (prev_key * PIANO_KEYS + next_key) and their totals,
+        see fetch_user_model. Replaces any model already held for the user.
+        """
+        self.user_models.pop(user_id, None)
+        model = self._new_model(user_id)
+        if cells:
+            model['counts'].reshape(-1)[np.array(cells, dtype=np.int64)] = totals
+        model['last_note'] = last_note
+        model['recent_notes_count'] = recent_notes_count
+    
+    def recent_notes_count(self, user_id: str) -> int:
+        """Number of notes recorded for the user, up to RECENT_NOTES_WINDOW"""
+        model = self.user_models.get(user_id)
+        return model['recent_notes_count'] if model else 0
+    
+    def update_and_predict(self, user_id: str, key_number: int) -> dict:
+        """Record a played note in the user's model and predict the next one"""
+        model = self.user_models.get(user_id)
+        if model is None:
+            model = self._new_model(user_id)
+        else:
+            self.user_models.move_to_end(user_id)
+        
+        counts = model['counts']
+        if model['last_note'] is not None:
+            counts[model['last_note'], key_number] += 1
+        model['last_note'] = key_number
+        model['recent_notes_count'] = min(model['recent_notes_count'] + 1, RECENT_NOTES_WINDOW)
+        
+        return self._top_predictions(counts[key_number])
+    
+    def _new_model(self, user_id: str) -> dict:
+        """Add an empty model for the user, evicting the least recently used"""
+        while len(self.user_models) >= MAX_USER_MODELS:
+            self.user_models.popitem(last=False)
+        
+        model = {
+            'counts': np.zeros((PIANO_KEYS, PIANO_KEYS), dtype=np.int32),
+            'last_note': None,
+            'recent_notes_count': 0,
+            'loaded_at': time.monotonic()
+        }
+        self.user_models[user_id] = model
+        return model
     
-    def predict_next_note(self, recent_notes: List[int]) -> dict:
-        """Predict likely next notes using simple Markov chain"""
-        if len(recent_notes) < 2:
+    def _top_predictions(self, counts: np.ndarray) -> dict:
+        """Top-3 next notes from a row of bigram counts"""
+        top = np.argsort(-counts, kind='stable')[:3]
+        top = top[counts[top] > 0]
+        if len(top) == 0:
             return {'predictions': [], 'confidence': 0.0}
         
-        # Simple bigram model
-        transitions = {}
-        for i in range(len(recent_notes) - 1):
-            current = recent_notes[i]
-            next_note = recent_notes[i + 1]
-            
-            if current not in transitions:
-                transitions[current] = {}
-            
-            if next_note not in transitions[current]:
-                transitions[current][next_note] = 0
-            
-            transitions[current][next_note] += 1
-        
-        last_note = recent_notes[-1]
-        if last_note in transitions:
-            predictions = sorted(
-                transitions[last_note].items(),
-                key=lambda x: x[1],
-                reverse=True
-            )[:3]
-            
-            total = sum(count for _, count in predictions)
-            return {
-                'predictions': [
-                    {'note': note, 'probability': count / total}
-                    for note, count in predictions
-                ],
-                'confidence': 0.6
-            }
+        # One tolist() call yields Python ints for the response
+        notes = top.tolist()
+        top_counts = counts[top].tolist()
+        total = sum(top_counts)
         
-        return {'predictions': [], 'confidence': 0.0}
+        return {
+            'predictions': [
+                {'note': note, 'probability': count / total}
+                for note, count in zip(notes, top_counts)
+            ],
+            'confidence': 0.6
+        }
 
 # Global ML analyzer instance
 ml_analyzer = MLAnalyzer()
 
 # Database Functions
+class PreparingConnection(PgConnection):
+    """Connection tracking the server-side prepared statements it holds"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def execute_prepared(cur, name: str, query: str, params: tuple):
+    """
+    Execute query (using $1, $2, ... placeholders) as the prepared
+    statement name, preparing it on the cursor's connection on first use
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {query}")
+        conn.prepared.add(name)
+    
+    placeholders = ', '.join(['%s'] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+def orjson_dumps(obj) -> str:
+    """JSON encoder for psycopg2's Json adapter"""
+    return orjson.dumps(obj).decode()
+
+def init_db_pool():
+    """Create the shared connection pool, once even if called from several threads"""
+    global db_pool
+    if db_pool is not None:
+        return
+    with _db_pool_lock:
+        if db_pool is None:
+            db_pool = ThreadedConnectionPool(
+                minconn=DB_POOL_MIN_CONN,
+                maxconn=DB_POOL_MAX_CONN,
+                connection_factory=PreparingConnection,
+                **DB_CONFIG
+            )
+
 def get_db_connection():
-    """Create database connection"""
-    return psycopg2.connect(**DB_CONFIG)
+    """Borrow a connection from the pool"""
+    init_db_pool()
+    return db_pool.getconn()
+
+@contextmanager
+def db_conn():
+    """
+    Yield a pooled connection and return it to the pool afterwards, waiting
+    for a free one when the pool is exhausted
+    """
+    with _db_conn_slots:
+        conn = get_db_connection()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn, close=bool(conn.closed))
 
 def init_database():
     """Initialize database tables"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (INIT_DB_LOCK_ID,))
+        
+        # Users table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id VARCHAR(255) PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Songs table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS songs (
+                song_id SERIAL PRIMARY KEY,
+                user_id VARCHAR(255) REFERENCES users(user_id),
+                song_name VARCHAR(255) NOT NULL,
+                notes JSONB NOT NULL,
+                metadata JSONB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Note events table for analytics
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS note_events (
+                event_id SERIAL PRIMARY KEY,
+                user_id VARCHAR(255) REFERENCES users(user_id),
+                key_number INTEGER NOT NULL,
+                velocity FLOAT NOT NULL,
+                timestamp BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Analytics cache table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS analytics_cache (
+                cache_id SERIAL PRIMARY KEY,
+                user_id VARCHAR(255) REFERENCES users(user_id),
+                analysis_type VARCHAR(100) NOT NULL,
+                results JSONB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Indexes for per-user lookups
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_note_events_user_ts
+            ON note_events(user_id, timestamp DESC, event_id DESC)
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_songs_user_id
+            ON songs(user_id)
+        """)
+        
+        # Bigram transition counts behind the next-note predictions
+        cur.execute("SELECT to_regclass('note_transitions') IS NOT NULL")
+        transitions_exist = cur.fetchone()[0]
+        
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS note_transitions (
+                user_id VARCHAR(255) REFERENCES users(user_id),
+                prev_key INTEGER NOT NULL,
+                next_key INTEGER NOT NULL,
+                count BIGINT NOT NULL,
+                PRIMARY KEY (user_id, prev_key, next_key)
+            )
+        """)
+        
+        # Backfill from existing note history the first time
+        if not transitions_exist:
+            cur.execute("""
+                INSERT INTO note_transitions (user_id, prev_key, next_key, count)
+                SELECT user_id, prev_key, key_number, COUNT(*)
+                FROM (
+                    SELECT user_id, key_number,
+                           LAG(key_number) OVER (
+                               PARTITION BY user_id ORDER BY timestamp, event_id
+                           ) AS prev_key
+                    FROM note_events
+                    WHERE user_id IS NOT NULL
+                ) steps
+                WHERE prev_key BETWEEN 0 AND %s AND key_number BETWEEN 0 AND %s
+                GROUP BY user_id, prev_key, key_number
+            """, (PIANO_KEYS - 1, PIANO_KEYS - 1))
+        
+        # Last key written and number of events per user, so transitions
+        # chain across inserts and the analytics cache can be checked cheaply
+        cur.execute("SELECT to_regclass('note_last_keys') IS NOT NULL")
+        last_keys_exist = cur.fetchone()[0]
+        
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS note_last_keys (
+                user_id VARCHAR(255) PRIMARY KEY REFERENCES users(user_id),
+                last_key INTEGER,
+                event_count BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+        cur.execute("""
+            ALTER TABLE note_last_keys
+            ADD COLUMN IF NOT EXISTS event_count BIGINT NOT NULL DEFAULT 0
+        """)
+        
+        if not last_keys_exist:
+            cur.execute("""
+                INSERT INTO note_last_keys (user_id, last_key, event_count)
+                SELECT DISTINCT ON (user_id) user_id, key_number,
+                       COUNT(*) OVER (PARTITION BY user_id)
+                FROM note_events
+                WHERE user_id IS NOT NULL
+                ORDER BY user_id, timestamp DESC, event_id DESC
+            """)
+        
+        # Both tables are kept current by a trigger, so notes written by the
+        # other backends reach the bigram models too
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION record_note_transitions()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                -- Lock each user's last-key row in user order, creating missing ones
+                INSERT INTO note_last_keys (user_id)
+                SELECT DISTINCT user_id FROM new_events
+                WHERE user_id IS NOT NULL
+                ORDER BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET last_key = note_last_keys.last_key;
+                
+                -- Each user's first new note follows their stored last key
+                INSERT INTO note_transitions (user_id, prev_key, next_key, count)
+                SELECT user_id, prev_key, key_number, COUNT(*)
+                FROM (
+                    SELECT e.user_id, e.key_number,
+                           LAG(e.key_number, 1, k.last_key) OVER (
+                               PARTITION BY e.user_id ORDER BY e.event_id
+                           ) AS prev_key
+                    FROM new_events e
+                    JOIN note_last_keys k ON k.user_id = e.user_id
+                ) steps
+                WHERE prev_key BETWEEN 0 AND %s AND key_number BETWEEN 0 AND %s
+                GROUP BY user_id, prev_key, key_number
+                ORDER BY user_id, prev_key, key_number
+                ON CONFLICT (user_id, prev_key, next_key)
+                DO UPDATE SET count = note_transitions.count + EXCLUDED.count;
+                
+                UPDATE note_last_keys k
+                SET last_key = e.key_number,
+                    event_count = k.event_count + e.inserted
+                FROM (
+                    SELECT DISTINCT ON (user_id) user_id, key_number,
+                           COUNT(*) OVER (PARTITION BY user_id) AS inserted
+                    FROM new_events
+                    WHERE user_id IS NOT NULL
+                    ORDER BY user_id, event_id DESC
+                ) e
+                WHERE k.user_id = e.user_id;
+                
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """, (PIANO_KEYS - 1, PIANO_KEYS - 1))
+        cur.execute("""
+            CREATE OR REPLACE TRIGGER record_note_transitions_on_insert
+            AFTER INSERT ON note_events
+            REFERENCING NEW TABLE AS new_events
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION record_note_transitions()
+        """)
+        
+        # Overall analytics are cached per user, keyed by note_last_keys.event_count
+        cur.execute("""
+            ALTER TABLE analytics_cache
+            ADD COLUMN IF NOT EXISTS cached_event_count BIGINT
+        """)
+        
+        # The cache lookup and upsert need a unique index on (user_id,
+        # analysis_type); database_schema.sql declares one for every type
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_indexes
+                WHERE schemaname = current_schema()
+                  AND tablename = 'analytics_cache'
+                  AND indexdef LIKE 'CREATE UNIQUE INDEX % USING btree (user_id, analysis_type)'
+            )
+        """)
+        if not cur.fetchone()[0]:
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_analytics_cache_overall
+                ON analytics_cache(user_id, analysis_type)
+                WHERE analysis_type = 'overall'
+            """)
+        
+        conn.commit()
+
+def fetch_user_model(user_id: str) -> tuple:
+    """
+    Fetch what is needed to rebuild a user's bigram model: their stored
+    transitions as flat matrix cells and totals, last note played and note
+    count up to RECENT_NOTES_WINDOW. Transitions come back as two arrays in a single row rather than
+    one row object per transition.
+    """
+    with db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(array_agg(prev_key * %s + next_key), '{}'),
+                   COALESCE(array_agg(count), '{}')
+            FROM note_transitions
+            WHERE user_id = %s
+        """, (PIANO_KEYS, user_id))
+        
+        cells, totals = cur.fetchone()
+        
+        cur.execute("""
+            SELECT last_key FROM note_last_keys
+            WHERE user_id = %s
+        """, (user_id,))
+        
+        row = cur.fetchone()
+        last_note = row[0] if row else None
+        
+        cur.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM note_events
+                WHERE user_id = %s
+                LIMIT %s
+            ) recent
+        """, (user_id, RECENT_NOTES_WINDOW))
+        
+        recent_notes_count = cur.fetchone()[0]
     
-    # Users table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id VARCHAR(255) PRIMARY KEY,
-            username VARCHAR(255) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    return cells, totals, last_note, recent_notes_count
+
+def insert_note_events(batch: List[tuple]):
+    """
+    Insert a batch of (user_id, key_number, velocity, timestamp) events; the
+    record_note_transitions trigger adds their transitions to note_transitions
+    """
+    # Per-row triggers update each event's users row; inserting in user order
+    # (stable, so each user's notes keep their order) makes concurrent
+    # flushes lock those rows in the same order and not deadlock
+    batch = sorted(batch, key=lambda event: event[0])
     
-    # Songs table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS songs (
-            song_id SERIAL PRIMARY KEY,
-            user_id VARCHAR(255) REFERENCES users(user_id),
-            song_name VARCHAR(255) NOT NULL,
-            notes JSONB NOT NULL,
-            metadata JSONB,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    with db_conn() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO note_events (user_id, key_number, velocity, timestamp)
+            VALUES %s
+        """, batch, page_size=EVENT_BATCH_SIZE)
+        
+        conn.commit()
+
+def flush_note_events(batch: List[tuple]):
+    """
+    Write a batch of note events, retrying it and then falling back to one
+    event per transaction so a single bad event cannot drop the others
+    """
+    for attempt in range(1, EVENT_FLUSH_ATTEMPTS + 1):
+        try:
+            insert_note_events(batch)
+            return
+        except Exception:
+            logger.warning(
+                "Note event batch flush failed (attempt %d/%d, %d events)",
+                attempt, EVENT_FLUSH_ATTEMPTS, len(batch), exc_info=True
+            )
+            time.sleep(EVENT_RETRY_DELAY)
     
-    # Note events table for analytics
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS note_events (
-            event_id SERIAL PRIMARY KEY,
-            user_id VARCHAR(255) REFERENCES users(user_id),
-            key_number INTEGER NOT NULL,
-            velocity FLOAT NOT NULL,
-            timestamp BIGINT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    for event in batch:
+        try:
+            insert_note_events([event])
+        except Exception:
+            logger.exception("Dropping note event %r", event)
+
+def drain_event_queue(batch: List[tuple]) -> List[tuple]:
+    """Move queued events into batch without waiting, up to EVENT_BATCH_SIZE"""
+    while len(batch) < EVENT_BATCH_SIZE and not event_queue.empty():
+        batch.append(event_queue.get_nowait())
+    return batch
+
+async def note_event_writer():
+    """Background task flushing buffered note events in batches"""
+    while True:
+        batch = [await event_queue.get()]
+        await asyncio.sleep(EVENT_FLUSH_INTERVAL)
+        drain_event_queue(batch)
+        
+        try:
+            await asyncio.to_thread(flush_note_events, batch)
+        except Exception:
+            logger.exception("Note event flush failed")
+        finally:
+            for _ in batch:
+                event_queue.task_done()
+
+def store_song(song: Song, metadata: dict, analysis: dict) -> int:
+    """Store a song with its analysis and return the new song id"""
+    with db_conn() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'insert_song', """
+            INSERT INTO songs (user_id, song_name, notes, metadata)
+            VALUES ($1, $2, $3, $4)
+            RETURNING song_id
+        """, (
+            song.user_id,
+            song.song_name,
+            Json(song.notes, dumps=orjson_dumps),
+            Json(metadata, dumps=orjson_dumps)
+        ))
+        
+        song_id = cur.fetchone()[0]
+        
+        # Cache analysis
+        execute_prepared(cur, 'insert_song_analysis', """
+            INSERT INTO analytics_cache (user_id, analysis_type, results)
+            VALUES ($1, 'song_analysis', $2)
+        """, (song.user_id, Json(analysis, dumps=orjson_dumps)))
+        
+        conn.commit()
     
-    # Analytics cache table
+    return song_id
+
+def aggregate_note_events(cur, user_id: str) -> dict:
+    """
+    Aggregate a user's note history in the database. Intervals follow play
+    order (timestamp, then event_id). event_count is the user's
+    note_last_keys counter, read in the same snapshot as the aggregates.
+    """
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS analytics_cache (
-            cache_id SERIAL PRIMARY KEY,
-            user_id VARCHAR(255) REFERENCES users(user_id),
-            analysis_type VARCHAR(100) NOT NULL,
-            results JSONB NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        WITH steps AS (
+            SELECT key_number,
+                   key_number - LAG(key_number) OVER (
+                       ORDER BY timestamp, event_id
+                   ) AS step
+            FROM note_events
+            WHERE user_id = %s
         )
-    """)
+        SELECT COUNT(*) AS note_count,
+               (SELECT event_count FROM note_last_keys
+                WHERE user_id = %s) AS event_count,
+               AVG(key_number) AS mean_pitch,
+               STDDEV_POP(key_number) AS std_pitch,
+               MAX(key_number) - MIN(key_number) AS pitch_range,
+               COUNT(DISTINCT key_number) AS unique_notes,
+               AVG(step) AS mean_interval,
+               VAR_POP(step) AS interval_variance,
+               COUNT(*) FILTER (WHERE step > 0) AS ascending_steps,
+               COUNT(*) FILTER (WHERE step < 0) AS descending_steps,
+               COUNT(*) FILTER (WHERE step = 0) AS repeated_notes
+        FROM steps
+    """, (user_id, user_id))
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    return cur.fetchone()
+
+def load_user_analytics(user_id: str) -> tuple:
+    """
+    Return (overall analytics, saved song count) for a user. The analytics
+    are served from analytics_cache while the user's event counter in
+    note_last_keys, kept by the record_note_transitions trigger, still
+    matches the one the cached results were computed from, so checking the
+    cache is a primary-key lookup.
+    """
+    with db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        execute_prepared(cur, 'cached_overall_analytics', """
+            SELECT k.event_count, c.results, c.cached_event_count
+            FROM note_last_keys k
+            LEFT JOIN analytics_cache c
+                ON c.user_id = k.user_id AND c.analysis_type = 'overall'
+            WHERE k.user_id = $1
+        """, (user_id,))
+        
+        cached = cur.fetchone()
+        
+        if cached is not None and cached['cached_event_count'] == cached['event_count']:
+            results = cached['results']
+        else:
+            stats = aggregate_note_events(cur, user_id)
+            results = {
+                'total_notes_played': stats['note_count'],
+                'overall_analysis': ml_analyzer.analyze_aggregates(stats)
+            }
+            
+            if stats['event_count'] is not None:
+                execute_prepared(cur, 'upsert_overall_analytics', """
+                    INSERT INTO analytics_cache
+                        (user_id, analysis_type, results, cached_event_count)
+                    VALUES ($1, 'overall', $2, $3)
+                    ON CONFLICT (user_id, analysis_type) WHERE analysis_type = 'overall'
+                    DO UPDATE SET results = EXCLUDED.results,
+                                  cached_event_count = EXCLUDED.cached_event_count,
+                                  updated_at = CURRENT_TIMESTAMP
+                """, (user_id, Json(results, dumps=orjson_dumps), stats['event_count']))
+        
+        # Get saved songs count
+        execute_prepared(cur, 'song_count', """
+            SELECT COUNT(*) as song_count FROM songs
+            WHERE user_id = $1
+        """, (user_id,))
+        
+        song_count = cur.fetchone()['song_count']
+        
+        conn.commit()
+    
+    return results, song_count
 
 # API Endpoints
 @app.on_event("startup")
 async def startup_event():
     """Initialize database on startup"""
+    global event_queue, event_writer_task
+    event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAX)
+    event_writer_task = asyncio.create_task(note_event_writer())
+    
     try:
-        init_database()
+        await asyncio.to_thread(init_database)
         print("✓ Python Backend: Database initialized")
     except Exception as e:
         print(f"✗ Database initialization error: {e}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush buffered note events and close pooled connections on shutdown"""
+    if event_writer_task is not None:
+        await event_queue.join()
+        event_writer_task.cancel()
+    
+    if db_pool is not None:
+        db_pool.closeall()
+
 @app.post("/api/python/process-note-ml")
 async def process_note_ml(event: NoteEvent):
     """
@@ -202,31 +891,19 @@ async def process_note_ml(event: NoteEvent):
     Architecture: Event-driven ML pipeline
     """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Store note event
-        cur.execute("""
-            INSERT INTO note_events (user_id, key_number, velocity, timestamp)
-            VALUES (%s, %s, %s, %s)
-        """, (event.user_id, event.key_number, event.velocity, event.timestamp))
-        
-        # Get recent notes for analysis
-        cur.execute("""
-            SELECT key_number FROM note_events
-            WHERE user_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 20
-        """, (event.user_id,))
-        
-        recent_notes = [row[0] for row in cur.fetchall()]
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        # (Re)load the user's stored model when this worker has none or
+        # its copy is older than USER_MODEL_TTL
+        if not ml_analyzer.has_user_model(event.user_id):
+            model = await asyncio.to_thread(fetch_user_model, event.user_id)
+            ml_analyzer.load_model(event.user_id, *model)
         
         # Perform ML analysis
-        prediction = ml_analyzer.predict_next_note(recent_notes)
+        prediction = ml_analyzer.update_and_predict(event.user_id, event.key_number)
+        
+        # Queue note event for the batched writer
+        await event_queue.put(
+            (event.user_id, event.key_number, event.velocity, event.timestamp)
+        )
         
         return {
             'backend': 'python',
@@ -234,7 +911,7 @@ async def process_note_ml(event: NoteEvent):
             'key_number': event.key_number,
             'processed': True,
             'ml_prediction': prediction,
-            'recent_notes_count': len(recent_notes),
+            'recent_notes_count': ml_analyzer.recent_notes_count(event.user_id),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -245,32 +922,13 @@ async def process_note_ml(event: NoteEvent):
 async def save_song(song: Song):
     """Save song to database with ML analysis"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         # Analyze song before saving
         analysis = ml_analyzer.analyze_melody(song.notes)
         
         metadata = song.metadata or {}
         metadata['ml_analysis'] = analysis
         
-        cur.execute("""
-            INSERT INTO songs (user_id, song_name, notes, metadata)
-            VALUES (%s, %s, %s, %s)
-            RETURNING song_id
-        """, (song.user_id, song.song_name, json.dumps(song.notes), json.dumps(metadata)))
-        
-        song_id = cur.fetchone()[0]
-        
-        # Cache analysis
-        cur.execute("""
-            INSERT INTO analytics_cache (user_id, analysis_type, results)
-            VALUES (%s, %s, %s)
-        """, (song.user_id, 'song_analysis', json.dumps(analysis)))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        song_id = await asyncio.to_thread(store_song, song, metadata, analysis)
         
         return {
             'song_id': song_id,
@@ -286,40 +944,13 @@ async def save_song(song: Song):
 async def get_user_analytics(user_id: str):
     """Get comprehensive user analytics"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Get all user notes
-        cur.execute("""
-            SELECT key_number FROM note_events
-            WHERE user_id = %s
-            ORDER BY timestamp ASC
-        """, (user_id,))
-        
-        all_notes = [row['key_number'] for row in cur.fetchall()]
-        
-        # Get saved songs count
-        cur.execute("""
-            SELECT COUNT(*) as song_count FROM songs
-            WHERE user_id = %s
-        """, (user_id,))
-        
-        song_count = cur.fetchone()['song_count']
-        
-        cur.close()
-        conn.close()
-        
-        # Comprehensive analysis
-        if all_notes:
-            analysis = ml_analyzer.analyze_melody(all_notes)
-        else:
-            analysis = {}
+        results, song_count = await asyncio.to_thread(load_user_analytics, user_id)
         
         return {
             'user_id': user_id,
-            'total_notes_played': len(all_notes),
+            'total_notes_played': results['total_notes_played'],
             'songs_saved': song_count,
-            'overall_analysis': analysis,
+            'overall_analysis': results['overall_analysis'],
             'backend': 'python',
             'architecture': 'ML/Analytics Pipeline'
         }
@@ -339,4 +970,11 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    uvicorn.run(
+        "python_backend:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=API_WORKERS,
+        loop="uvloop",
+        http="httptools"
+    )